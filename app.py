@@ -1,10 +1,13 @@
 import streamlit as st
-import google.generativeai as genai
-from PIL import Image
 import os
-from dotenv import load_dotenv
-from streamlit_image_comparison import image_comparison
 import io
+import threading
+import time
+from prompts import build_prompt
+from profiling import RerunProfiler
+from app_resources import (
+    DRAFT_MODEL_NAME, get_file_refs, get_model, get_render_index, load_css, load_env, load_render, upload_dhash
+)
 
 # --- ページ設定 ---
 st.set_page_config(
@@ -14,415 +17,16 @@ st.set_page_config(
     initial_sidebar_state="expanded"
 )
 
+# 再実行ごとの処理時間計測（?profile=1 で表示）
+profiler = RerunProfiler()
+
+load_env()
+
 # --- カスタムCSS ---
-st.markdown("""
+# static/style.css はプロセスで1回だけ読み込み、キャッシュした内容を埋め込む
+st.markdown(f"""
 <style>
-    /* Google Fonts */
-    @import url('https://fonts.googleapis.com/css2?family=Archivo+Black&family=DM+Sans:wght@300;400;500;600;700&family=JetBrains+Mono:wght@400;500&display=swap');
-
-    /* Root variables */
-    :root {
-        --arch-dark: #0a0a0b;
-        --arch-charcoal: #141416;
-        --arch-slate: #1c1c1f;
-        --arch-steel: #2a2a2e;
-        --arch-mist: #f5f3ef;
-        --arch-cream: #ebe7df;
-        --arch-gold: #c9a962;
-        --arch-copper: #b87333;
-        --arch-blueprint: #1a3a5c;
-    }
-
-    /* Main app background */
-    .stApp {
-        background: linear-gradient(180deg, #0a0a0b 0%, #0d0d0e 100%);
-        background-image:
-            linear-gradient(rgba(26, 58, 92, 0.03) 1px, transparent 1px),
-            linear-gradient(90deg, rgba(26, 58, 92, 0.03) 1px, transparent 1px);
-        background-size: 100% 100%, 40px 40px;
-    }
-
-    /* Hide Streamlit branding */
-    #MainMenu {visibility: hidden;}
-    footer {visibility: hidden;}
-
-    /* Keep header for sidebar toggle button */
-    header[data-testid="stHeader"] {
-        background: transparent;
-        backdrop-filter: none;
-    }
-
-    /* Hide decoration but keep toggle */
-    header[data-testid="stHeader"]::before {
-        display: none;
-    }
-
-    /* Sidebar styling */
-    [data-testid="stSidebar"] {
-        background: linear-gradient(180deg, #141416 0%, #0a0a0b 100%);
-        border-right: 1px solid rgba(201, 169, 98, 0.1);
-    }
-
-    [data-testid="stSidebar"] .stMarkdown {
-        color: #f5f3ef;
-    }
-
-    /* Headers */
-    h1, h2, h3 {
-        font-family: 'Archivo Black', sans-serif !important;
-        color: #f5f3ef !important;
-        letter-spacing: 0.05em;
-    }
-
-    h1 {
-        background: linear-gradient(135deg, #c9a962 0%, #b87333 50%, #c9a962 100%);
-        -webkit-background-clip: text;
-        -webkit-text-fill-color: transparent;
-        background-clip: text;
-        font-size: 2.5rem !important;
-        margin-bottom: 0 !important;
-    }
-
-    /* Body text */
-    p, span, label, .stMarkdown {
-        font-family: 'DM Sans', sans-serif !important;
-        color: #ebe7df;
-    }
-
-    /* Captions and small text */
-    .stCaption, small {
-        font-family: 'JetBrains Mono', monospace !important;
-        color: rgba(245, 243, 239, 0.4) !important;
-        letter-spacing: 0.1em;
-        text-transform: uppercase;
-        font-size: 0.7rem !important;
-    }
-
-    /* File uploader */
-    [data-testid="stFileUploader"] {
-        background: rgba(20, 20, 22, 0.7);
-        border: 2px dashed rgba(201, 169, 98, 0.3);
-        border-radius: 0;
-        padding: 2rem;
-        transition: all 0.3s ease;
-    }
-
-    [data-testid="stFileUploader"]:hover {
-        border-color: rgba(201, 169, 98, 0.6);
-        background: rgba(201, 169, 98, 0.05);
-    }
-
-    [data-testid="stFileUploader"] label {
-        color: #ebe7df !important;
-    }
-
-    /* Buttons */
-    .stButton > button {
-        font-family: 'DM Sans', sans-serif !important;
-        font-weight: 600;
-        letter-spacing: 0.05em;
-        background: linear-gradient(135deg, #c9a962 0%, #b87333 100%);
-        color: #0a0a0b !important;
-        border: none;
-        border-radius: 0;
-        padding: 0.8rem 2rem;
-        transition: all 0.3s ease;
-        text-transform: uppercase;
-    }
-
-    .stButton > button:hover {
-        background: linear-gradient(135deg, #d4b46d 0%, #c9843e 100%);
-        box-shadow: 0 0 30px rgba(201, 169, 98, 0.3);
-        transform: translateY(-1px);
-    }
-
-    .stButton > button:active {
-        transform: translateY(0);
-    }
-
-    /* Secondary buttons */
-    .stDownloadButton > button {
-        background: rgba(42, 42, 46, 0.8) !important;
-        color: #ebe7df !important;
-        border: 1px solid rgba(201, 169, 98, 0.3) !important;
-    }
-
-    .stDownloadButton > button:hover {
-        background: rgba(201, 169, 98, 0.1) !important;
-        border-color: rgba(201, 169, 98, 0.6) !important;
-    }
-
-    /* Radio buttons */
-    [data-testid="stRadio"] > label {
-        color: rgba(245, 243, 239, 0.6) !important;
-        font-family: 'JetBrains Mono', monospace !important;
-        font-size: 0.75rem !important;
-        letter-spacing: 0.1em;
-        text-transform: uppercase;
-    }
-
-    [data-testid="stRadio"] div[role="radiogroup"] label {
-        background: rgba(20, 20, 22, 0.7);
-        border: 1px solid rgba(42, 42, 46, 0.8);
-        padding: 0.8rem 1.2rem;
-        margin: 0.3rem 0;
-        transition: all 0.3s ease;
-    }
-
-    [data-testid="stRadio"] div[role="radiogroup"] label:hover {
-        border-color: rgba(201, 169, 98, 0.4);
-        background: rgba(201, 169, 98, 0.05);
-    }
-
-    [data-testid="stRadio"] div[role="radiogroup"] label[data-checked="true"] {
-        border-color: rgba(201, 169, 98, 0.6);
-        background: rgba(201, 169, 98, 0.1);
-    }
-
-    /* Checkboxes */
-    [data-testid="stCheckbox"] {
-        background: rgba(20, 20, 22, 0.7);
-        border: 1px solid rgba(42, 42, 46, 0.8);
-        padding: 0.8rem 1rem;
-        margin: 0.5rem 0;
-        transition: all 0.3s ease;
-    }
-
-    [data-testid="stCheckbox"]:hover {
-        border-color: rgba(201, 169, 98, 0.4);
-    }
-
-    [data-testid="stCheckbox"] label span {
-        color: #ebe7df !important;
-    }
-
-    /* Text area */
-    .stTextArea textarea {
-        font-family: 'DM Sans', sans-serif !important;
-        background: rgba(20, 20, 22, 0.9) !important;
-        border: 1px solid rgba(42, 42, 46, 0.8) !important;
-        color: #ebe7df !important;
-        border-radius: 0 !important;
-    }
-
-    .stTextArea textarea:focus {
-        border-color: rgba(201, 169, 98, 0.5) !important;
-        box-shadow: 0 0 0 1px rgba(201, 169, 98, 0.2) !important;
-    }
-
-    .stTextArea textarea::placeholder {
-        color: rgba(245, 243, 239, 0.3) !important;
-    }
-
-    /* Info boxes */
-    .stAlert {
-        background: rgba(26, 58, 92, 0.1) !important;
-        border: 1px solid rgba(26, 58, 92, 0.3) !important;
-        border-radius: 0 !important;
-        color: #ebe7df !important;
-    }
-
-    /* Spinner */
-    .stSpinner > div {
-        border-color: #c9a962 transparent transparent transparent !important;
-    }
-
-    /* Divider */
-    hr {
-        border-color: rgba(201, 169, 98, 0.1) !important;
-    }
-
-    /* Image containers */
-    [data-testid="stImage"] {
-        border: 1px solid rgba(201, 169, 98, 0.1);
-        background: rgba(20, 20, 22, 0.5);
-    }
-
-    /* Columns gap */
-    [data-testid="column"] {
-        padding: 0.5rem;
-    }
-
-    /* Success message */
-    .stSuccess {
-        background: rgba(201, 169, 98, 0.1) !important;
-        border: 1px solid rgba(201, 169, 98, 0.3) !important;
-        color: #c9a962 !important;
-    }
-
-    /* Error message */
-    .stError {
-        background: rgba(220, 38, 38, 0.1) !important;
-        border: 1px solid rgba(220, 38, 38, 0.3) !important;
-    }
-
-    /* Custom header component */
-    .custom-header {
-        display: flex;
-        align-items: center;
-        gap: 1rem;
-        padding: 1rem 0 2rem 0;
-        border-bottom: 1px solid rgba(201, 169, 98, 0.1);
-        margin-bottom: 2rem;
-    }
-
-    .logo-mark {
-        width: 50px;
-        height: 50px;
-        position: relative;
-        display: flex;
-        align-items: center;
-        justify-content: center;
-    }
-
-    .logo-mark::before {
-        content: '';
-        position: absolute;
-        width: 100%;
-        height: 100%;
-        border: 1px solid rgba(201, 169, 98, 0.5);
-        transform: rotate(45deg);
-    }
-
-    .logo-mark::after {
-        content: '';
-        position: absolute;
-        width: 70%;
-        height: 70%;
-        background: rgba(201, 169, 98, 0.1);
-        transform: rotate(45deg);
-    }
-
-    .logo-text {
-        color: #c9a962;
-        font-family: 'Archivo Black', sans-serif;
-        font-size: 1.2rem;
-        position: relative;
-        z-index: 1;
-    }
-
-    /* Section headers */
-    .section-header {
-        display: flex;
-        align-items: center;
-        gap: 0.75rem;
-        margin-bottom: 1rem;
-    }
-
-    .section-number {
-        width: 24px;
-        height: 24px;
-        border: 1px solid rgba(201, 169, 98, 0.5);
-        transform: rotate(45deg);
-        display: flex;
-        align-items: center;
-        justify-content: center;
-        font-family: 'JetBrains Mono', monospace;
-        font-size: 0.7rem;
-        color: #c9a962;
-    }
-
-    .section-number span {
-        transform: rotate(-45deg);
-    }
-
-    /* Glass panel effect */
-    .glass-panel {
-        background: rgba(20, 20, 22, 0.7);
-        backdrop-filter: blur(20px);
-        -webkit-backdrop-filter: blur(20px);
-        border: 1px solid rgba(201, 169, 98, 0.1);
-        padding: 1.5rem;
-        margin-bottom: 1rem;
-    }
-
-    /* Processing info */
-    .processing-info {
-        font-family: 'JetBrains Mono', monospace;
-        font-size: 0.75rem;
-        color: rgba(245, 243, 239, 0.5);
-        padding: 1rem;
-        background: rgba(26, 58, 92, 0.1);
-        border: 1px solid rgba(26, 58, 92, 0.2);
-    }
-
-    .processing-info li {
-        display: flex;
-        align-items: center;
-        gap: 0.5rem;
-        margin: 0.5rem 0;
-    }
-
-    .processing-info li::before {
-        content: '';
-        width: 4px;
-        height: 4px;
-        background: rgba(201, 169, 98, 0.5);
-        transform: rotate(45deg);
-    }
-
-    /* Footer */
-    .custom-footer {
-        position: fixed;
-        bottom: 0;
-        left: 0;
-        right: 0;
-        padding: 0.75rem 2rem;
-        background: rgba(10, 10, 11, 0.9);
-        border-top: 1px solid rgba(42, 42, 46, 0.3);
-        display: flex;
-        justify-content: space-between;
-        font-family: 'JetBrains Mono', monospace;
-        font-size: 0.7rem;
-        color: rgba(245, 243, 239, 0.3);
-        z-index: 1000;
-    }
-
-    /* Ambient glow effects */
-    .ambient-glow {
-        position: fixed;
-        pointer-events: none;
-        z-index: 0;
-    }
-
-    .glow-gold {
-        top: -200px;
-        left: 20%;
-        width: 400px;
-        height: 400px;
-        background: radial-gradient(circle, rgba(201, 169, 98, 0.05) 0%, transparent 70%);
-    }
-
-    .glow-blue {
-        bottom: -200px;
-        right: 20%;
-        width: 350px;
-        height: 350px;
-        background: radial-gradient(circle, rgba(26, 58, 92, 0.08) 0%, transparent 70%);
-    }
-
-    /* Result label badges */
-    .result-badge {
-        display: inline-block;
-        padding: 0.4rem 0.8rem;
-        font-family: 'JetBrains Mono', monospace;
-        font-size: 0.65rem;
-        letter-spacing: 0.1em;
-        text-transform: uppercase;
-        margin-bottom: 0.5rem;
-    }
-
-    .badge-before {
-        background: rgba(42, 42, 46, 0.8);
-        border: 1px solid rgba(42, 42, 46, 0.5);
-        color: rgba(245, 243, 239, 0.6);
-    }
-
-    .badge-after {
-        background: rgba(201, 169, 98, 0.1);
-        border: 1px solid rgba(201, 169, 98, 0.3);
-        color: #c9a962;
-    }
+{load_css()}
 </style>
 
 <!-- Ambient glow effects -->
@@ -430,6 +34,8 @@ st.markdown("""
 <div class="ambient-glow glow-blue"></div>
 """, unsafe_allow_html=True)
 
+profiler.mark("CSS")
+
 # ==========================================
 # パスワード認証機能
 # ==========================================
@@ -479,13 +85,21 @@ def check_password():
     return False
 
 if not check_password():
+    profiler.mark("認証")
+    profiler.render()
     st.stop()
 
+profiler.mark("認証")
+
+# 重いモジュールは認証後に読み込む（ログイン画面では読み込まない）
+from google.api_core import exceptions as google_exceptions
+from PIL import Image
+from streamlit_image_comparison import image_comparison
+from file_refs import is_file_ref_error
+
 # ==========================================
 # APIキーとモデルの設定
 # ==========================================
-load_dotenv()
-
 try:
     api_key = st.secrets["GEMINI_API_KEY"]
 except:
@@ -495,16 +109,112 @@ if not api_key:
     st.error("APIキーが見つかりません。")
     st.stop()
 
-genai.configure(api_key=api_key)
-
-MODEL_NAME = 'models/nano-banana-pro-preview'
-
 try:
-    model = genai.GenerativeModel(MODEL_NAME)
+    model = get_model(api_key)
+    # 下書きは安価・高速なモデルで生成する
+    draft_model = get_model(api_key, os.getenv("GEMINI_DRAFT_MODEL", DRAFT_MODEL_NAME))
 except Exception as e:
     st.error(f"モデルの読み込みに失敗しました: {e}")
     st.stop()
 
+render_index = get_render_index()
+file_refs = get_file_refs()
+
+# 下書き生成の入力サイズ（長辺のピクセル数）
+DRAFT_MAX_SIZE = 512
+# 下書きを表示してから高画質版を開始するまでの猶予（秒）。この間にオプションを変えれば高画質版は生成しない
+FINAL_DELAY = 5
+
+def generate_image(prompt, image, source=None, mime_type=None, cancelled=None, draft=False):
+    """Gemini で画像を生成し、PIL 画像を返す（取得できない・取り消された場合は None）
+
+    source（元画像のバイト列）を渡すと、画像を一度だけアップロードして参照で送る。
+    cancelled（threading.Event）がセットされていれば Gemini へは送信しない。
+    draft が True なら下書き用のモデルで生成する。
+    """
+    generation_model = draft_model if draft else model
+
+    def is_cancelled():
+        return cancelled is not None and cancelled.is_set()
+
+    if is_cancelled():
+        return None
+
+    image_part = image
+    file_uris = []
+    if source is not None:
+        try:
+            image_part = file_refs.get_part(source, mime_type)
+            file_uris.append(image_part['file_data']['file_uri'])
+        except Exception:
+            pass
+
+    if is_cancelled():
+        return None
+
+    try:
+        response = generation_model.generate_content([prompt, image_part])
+    except (google_exceptions.NotFound, google_exceptions.PermissionDenied, google_exceptions.InvalidArgument) as e:
+        if image_part is image or not is_file_ref_error(str(e), file_uris):
+            raise
+        # 参照したファイルが無効（削除・期限切れ）な場合のみ画像本体で送り直す
+        # （プロンプトの問題・タイムアウト・過負荷は送り直さずにそのままエラーとする）
+        file_refs.invalidate(source)
+        if is_cancelled():
+            return None
+        response = generation_model.generate_content([prompt, image])
+
+    # 画像データの取り出し
+    if hasattr(response, 'candidates') and response.candidates:
+        for part in response.candidates[0].content.parts:
+            if hasattr(part, 'inline_data') and part.inline_data:
+                return Image.open(io.BytesIO(part.inline_data.data))
+    return None
+
+class GenerationJob:
+    """バックグラウンドで実行する生成処理
+
+    開始前（delay の待機中を含む）に cancel() されたジョブは Gemini へ送信しない。
+    送信済みのリクエストは中断できないため、結果を破棄するだけになる。
+    """
+
+    def __init__(self, prompt, image, source=None, mime_type=None, delay=0, draft=False):
+        self.cancelled = threading.Event()
+        self.done = threading.Event()
+        self.result = None
+        self.error = None
+        threading.Thread(
+            target=self._run, args=(prompt, image, source, mime_type, delay, draft), daemon=True
+        ).start()
+
+    def _run(self, prompt, image, source, mime_type, delay, draft):
+        try:
+            if not self.cancelled.wait(delay):
+                self.result = generate_image(prompt, image, source, mime_type, self.cancelled, draft)
+        except Exception as e:
+            self.error = e
+        finally:
+            self.done.set()
+
+    def cancel(self):
+        self.cancelled.set()
+
+    def wait(self, slot, label):
+        """完了まで待つ。画面を更新し続けることで、オプション変更による再実行で中断できる"""
+        started = time.monotonic()
+        while not self.done.is_set():
+            slot.caption(f"{label} {time.monotonic() - started:.0f}s")
+            time.sleep(0.5)
+        slot.empty()
+
+def make_draft_image(image):
+    """下書き用に縮小した画像を返す"""
+    draft = image.copy()
+    draft.thumbnail((DRAFT_MAX_SIZE, DRAFT_MAX_SIZE))
+    return draft
+
+profiler.mark("初期化")
+
 # ==========================================
 # サイドバー
 # ==========================================
@@ -550,6 +260,7 @@ with st.sidebar:
 
     auto_background = st.checkbox("背景を自動生成", value=True, help="白い背景部分に空や風景を自動で追加します")
     enhance_texture = st.checkbox("質感を強調", value=True, help="コンクリート、ガラス、木材などの素材感を強調します")
+    draft_first = st.checkbox("下書きを先に表示", value=False, help="安価・高速なモデルで低解像度の下書きを先に生成して表示し、確認の猶予をおいてから高画質版を生成します")
 
     st.markdown("<br>", unsafe_allow_html=True)
 
@@ -584,6 +295,8 @@ with st.sidebar:
     </div>
     """, unsafe_allow_html=True)
 
+profiler.mark("サイドバー")
+
 # ==========================================
 # メインコンテンツ
 # ==========================================
@@ -607,13 +320,6 @@ st.markdown("""
         <span>Powered by Gemini</span>
     </div>
 </div>
-
-<style>
-@keyframes pulse {
-    0%, 100% { opacity: 1; }
-    50% { opacity: 0.5; }
-}
-</style>
 """, unsafe_allow_html=True)
 
 # File uploader
@@ -647,6 +353,7 @@ if uploaded_file is not None:
     st.markdown("<br>", unsafe_allow_html=True)
 
     if generate_btn:
+        profiler.exempt_from_budget()
         st.markdown("---")
 
         st.markdown("""
@@ -660,41 +367,47 @@ if uploaded_file is not None:
         generated_image = None
         error_message = None
 
-        with st.spinner(f"{'昼間' if is_daytime else '夜間'}のビジュアライゼーションを生成中..."):
-            try:
-                # プロンプト作成
-                time_setting = "bright natural daylight, clear blue sky, warm sunlight" if is_daytime else "dramatic night lighting, warm interior glow from windows, elegant evening atmosphere"
-
-                prompt = f"""You are an expert architectural visualizer. Enhance this building exterior perspective with professional quality.
-
-LIGHTING: {time_setting}
-
-REQUIREMENTS:
-- Significantly enhance global illumination and ambient occlusion
-- Deepen shadows for better depth perception
-- Maintain the original architectural design and proportions
-- Output a photorealistic, high-quality architectural visualization
-
-{"BACKGROUND: If the image has white or empty background areas, generate a realistic, contextual environment (sky, landscape, trees, or urban context) that seamlessly blends with the building and lighting." if auto_background else ""}
-
-{"TEXTURES: Enhance all surface materials (concrete, glass, wood, metal, stone) to appear highly detailed and photorealistic." if enhance_texture else ""}
-
-{f"ADDITIONAL INSTRUCTIONS: {custom_prompt}" if custom_prompt else ""}
-
-Deliver a stunning, professional architectural rendering."""
-
-                response = model.generate_content([prompt, original_image])
+        # プロンプト作成
+        prompt = build_prompt(is_daytime, auto_background, enhance_texture, custom_prompt)
+
+        draft_slot = st.empty()
+        status_slot = st.empty()
+        jobs = []
+
+        try:
+            final_delay = 0
+            if draft_first:
+                # 縮小画像で下書きを生成して先に表示する
+                draft_job = GenerationJob(prompt, make_draft_image(original_image), draft=True)
+                jobs.append(draft_job)
+                with st.spinner("下書きを生成中..."):
+                    draft_job.wait(status_slot, "下書きを生成中...")
+
+                if draft_job.result:
+                    with draft_slot.container():
+                        st.markdown(f'<div class="result-badge badge-after">下書き（{FINAL_DELAY}秒後に高画質版を生成・オプション変更で取り消し）</div>', unsafe_allow_html=True)
+                        st.image(draft_job.result, use_container_width=True)
+                    final_delay = FINAL_DELAY
+
+            # 下書きの確認中にオプションが変更されれば、高画質版は Gemini に送信されない
+            final_job = GenerationJob(
+                prompt, original_image, uploaded_file.getvalue(), uploaded_file.type, delay=final_delay
+            )
+            jobs.append(final_job)
+            with st.spinner(f"{'昼間' if is_daytime else '夜間'}のビジュアライゼーションを生成中..."):
+                final_job.wait(status_slot, "高画質版を生成中...")
 
-                # 画像データの取り出し
-                if hasattr(response, 'candidates') and response.candidates:
-                    for part in response.candidates[0].content.parts:
-                        if hasattr(part, 'inline_data') and part.inline_data:
-                            image_data = part.inline_data.data
-                            generated_image = Image.open(io.BytesIO(image_data))
-                            break
+            if final_job.error:
+                error_message = str(final_job.error)
+            else:
+                generated_image = final_job.result
+        finally:
+            # 再実行で中断された場合は未完了のジョブを取り消す
+            for job in jobs:
+                if not job.done.is_set():
+                    job.cancel()
 
-            except Exception as e:
-                error_message = str(e)
+        draft_slot.empty()
 
         # spinner外で結果を表示
         if error_message:
@@ -716,6 +429,12 @@ Deliver a stunning, professional architectural rendering."""
             buf.seek(0)
             image_bytes = buf.getvalue()
 
+            # 類似画像インデックスに登録
+            try:
+                render_index.add(original_image, image_bytes, prompt=prompt, source=uploaded_file.name)
+            except Exception:
+                pass
+
             time_label = "daytime" if is_daytime else "nighttime"
             col1, col2, col3 = st.columns([2, 1, 2])
             with col2:
@@ -730,16 +449,61 @@ Deliver a stunning, professional architectural rendering."""
             st.warning("画像の生成に失敗しました。再度お試しください。")
 
     else:
-        # Preview only
-        st.markdown("""
-        <div class="section-header">
-            <div class="section-number"><span>02</span></div>
-            <span style="color: #ebe7df; font-weight: 500; letter-spacing: 0.05em;">プレビュー</span>
-        </div>
-        """, unsafe_allow_html=True)
+        # 類似画像の過去の生成結果（同じ生成オプションのもの）
+        is_daytime = "昼間" in time_of_day
+        similar = None
+        for distance, entry in render_index.lookup_hash(
+            upload_dhash(uploaded_file.getvalue()),
+            prompt=build_prompt(is_daytime, auto_background, enhance_texture, custom_prompt)
+        ):
+            try:
+                similar = distance, entry, load_render(entry["output"])
+                break
+            except FileNotFoundError:
+                # 結果のファイルが失われていればインデックスから外す
+                render_index.remove(entry)
+
+        if similar:
+            distance, entry, image_bytes = similar
+            st.markdown("""
+            <div class="section-header">
+                <div class="section-number"><span>02</span></div>
+                <span style="color: #ebe7df; font-weight: 500; letter-spacing: 0.05em;">類似の生成結果</span>
+            </div>
+            """, unsafe_allow_html=True)
+
+            st.info(f"類似した画像の生成結果が既にあります（差分 {distance}/64）。再生成する場合は「高画質化を実行」を押してください。")
+
+            # 比較スライダーは再実行ごとに両画像を再エンコードするため、結果画像のみ表示する
+            st.markdown('<div class="result-badge badge-after">既存の生成結果</div>', unsafe_allow_html=True)
+            st.image(image_bytes, use_container_width=True)
 
-        st.markdown('<div class="result-badge badge-before">元画像</div>', unsafe_allow_html=True)
-        st.image(original_image, use_container_width=True)
+            st.markdown("<br>", unsafe_allow_html=True)
+
+            time_label = "daytime" if is_daytime else "nighttime"
+            col1, col2, col3 = st.columns([2, 1, 2])
+            with col2:
+                st.download_button(
+                    label="ダウンロード",
+                    data=image_bytes,
+                    file_name=f"archienhance_{time_label}_{uploaded_file.name.split('.')[0]}.png",
+                    mime=entry["mime_type"],
+                    use_container_width=True
+                )
+
+        else:
+            # Preview only
+            st.markdown("""
+            <div class="section-header">
+                <div class="section-number"><span>02</span></div>
+                <span style="color: #ebe7df; font-weight: 500; letter-spacing: 0.05em;">プレビュー</span>
+            </div>
+            """, unsafe_allow_html=True)
+
+            st.markdown('<div class="result-badge badge-before">元画像</div>', unsafe_allow_html=True)
+            st.image(original_image, use_container_width=True)
+
+profiler.mark("メイン")
 
 # Footer
 st.markdown("""
@@ -751,3 +515,6 @@ st.markdown("""
 
 # Bottom padding for footer
 st.markdown("<div style='height: 60px;'></div>", unsafe_allow_html=True)
+
+profiler.mark("フッター")
+profiler.render()
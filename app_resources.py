@@ -0,0 +1,78 @@
+"""
+app.py が再実行をまたいで共有するリソース
+
+st.cache_resource / st.cache_data のデコレートは定義するたびに処理が走るため、
+再実行ごとに実行される app.py ではなく、1回だけ読み込まれるこのモジュールで定義する。
+重いモジュール（google.generativeai, PIL など）は各関数の中で読み込み、
+ログイン画面では読み込まれないようにしている。
+"""
+import io
+import os
+
+import streamlit as st
+from dotenv import load_dotenv
+
+MODEL_NAME = 'models/nano-banana-pro-preview'
+# 下書き用の安価・高速なモデル（環境変数 GEMINI_DRAFT_MODEL で変更可能）
+DRAFT_MODEL_NAME = 'models/gemini-2.5-flash-image'
+STYLE_PATH = os.path.join(os.path.dirname(os.path.abspath(__file__)), "static", "style.css")
+
+
+@st.cache_resource
+def load_env():
+    """.env の読み込み（プロセスで1回のみ）"""
+    load_dotenv()
+
+
+@st.cache_data
+def load_css():
+    """static/style.css を読み込む（プロセスで1回のみ）"""
+    with open(STYLE_PATH, encoding="utf-8") as f:
+        return f.read()
+
+
+@st.cache_resource
+def get_model(api_key, model_name=MODEL_NAME):
+    """APIの設定とモデルの作成（APIキー・モデルごとに1回のみ）"""
+    import google.generativeai as genai
+
+    genai.configure(api_key=api_key)
+    return genai.GenerativeModel(model_name)
+
+
+@st.cache_resource
+def get_render_index():
+    """類似画像インデックス（プロセス内で共有）
+
+    server.py とは別のディレクトリを使う（同じディレクトリでは互いの結果を削除してしまう）。
+    """
+    from render_index import MAX_BYTES, MAX_ENTRIES, RenderIndex
+
+    return RenderIndex(
+        os.getenv("RENDER_CACHE_DIR", os.path.join("render_cache", "app")),
+        int(os.getenv("RENDER_CACHE_MAX_ENTRIES", MAX_ENTRIES)),
+        int(os.getenv("RENDER_CACHE_MAX_BYTES", MAX_BYTES)),
+    )
+
+
+@st.cache_resource
+def get_file_refs():
+    """アップロード済み画像の参照（プロセス内で共有）"""
+    from file_refs import FileRefCache, GenaiFileUploader
+
+    return FileRefCache(GenaiFileUploader())
+
+
+@st.cache_data(max_entries=16, show_spinner=False)
+def upload_dhash(data):
+    """アップロード画像の dHash（同じアップロードでは再実行ごとに計算しない）"""
+    from PIL import Image
+    from render_index import dhash
+
+    return dhash(Image.open(io.BytesIO(data)))
+
+
+@st.cache_data(max_entries=8, show_spinner=False)
+def load_render(output):
+    """登録済みの生成結果を読み込む（再実行ごとにディスクから読まない）"""
+    return get_render_index().read_output({"output": output})
@@ -0,0 +1,247 @@
+"""
+建築パースの一括高画質化（オフライン CLI）
+
+使い方:
+    python batch.py temp/ -o output/ --time night --workers 4
+
+出力ディレクトリの manifest.json に処理済みファイルを「内容ハッシュ＋生成オプション」で
+記録し、再実行時は同じオプションで処理済みの画像をスキップする。
+"""
+import argparse
+import hashlib
+import io
+import json
+import os
+import random
+import sys
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor, as_completed
+
+import google.generativeai as genai
+from dotenv import load_dotenv
+from google.api_core import exceptions as google_exceptions
+from PIL import Image
+
+from prompts import build_prompt
+from render_index import prompt_digest
+
+MODEL_NAME = 'models/nano-banana-pro-preview'
+IMAGE_EXTENSIONS = ('.jpg', '.jpeg', '.png')
+MANIFEST_NAME = 'manifest.json'
+
+# リトライ設定（ファイルごとに独立）
+MAX_RETRIES = 3
+RETRY_DELAY = 5  # 秒
+# クォータ超過（429）は分単位で回復するため、上限付きの指数バックオフ（ジッター付き）で長めに待つ
+QUOTA_MAX_RETRIES = 8
+QUOTA_BASE_DELAY = 10  # 秒
+QUOTA_MAX_DELAY = 120  # 秒
+
+# 一時的なエラー（過負荷・タイムアウト・サーバー内部エラー）
+TRANSIENT_ERRORS = (
+    google_exceptions.ServiceUnavailable,
+    google_exceptions.DeadlineExceeded,
+    google_exceptions.InternalServerError,
+)
+
+
+def file_hash(path):
+    """ファイル内容の SHA-256 を返す"""
+    h = hashlib.sha256()
+    with open(path, 'rb') as f:
+        for chunk in iter(lambda: f.read(1 << 20), b''):
+            h.update(chunk)
+    return h.hexdigest()
+
+
+def job_key(digest, prompt):
+    """manifest のキー（同じ画像でも生成オプションが違えば別の処理として扱う）"""
+    return f'{digest}:{prompt_digest(prompt)}'
+
+
+class Manifest:
+    """処理済みファイルの記録（内容ハッシュ:オプション → 出力ファイル名）"""
+
+    def __init__(self, path):
+        self.path = path
+        self.lock = threading.Lock()
+        self.entries = {}
+        if os.path.exists(path):
+            with open(path, encoding='utf-8') as f:
+                self.entries = json.load(f)
+
+    def is_done(self, key):
+        entry = self.entries.get(key)
+        return bool(entry) and entry.get('status') == 'done' and os.path.exists(
+            os.path.join(os.path.dirname(self.path), entry['output'])
+        )
+
+    def record(self, key, entry):
+        # 1件ごとに書き出し、途中で中断しても再開できるようにする
+        with self.lock:
+            self.entries[key] = entry
+            tmp_path = self.path + '.tmp'
+            with open(tmp_path, 'w', encoding='utf-8') as f:
+                json.dump(self.entries, f, ensure_ascii=False, indent=2)
+            os.replace(tmp_path, self.path)
+
+
+class Progress:
+    """進捗と残り時間の表示"""
+
+    def __init__(self, total):
+        self.total = total
+        self.completed = 0
+        self.failed = 0
+        self.started = time.monotonic()
+        self.lock = threading.Lock()
+
+    def update(self, name, ok, message=''):
+        with self.lock:
+            self.completed += 1
+            if not ok:
+                self.failed += 1
+            elapsed = time.monotonic() - self.started
+            remaining = (elapsed / self.completed) * (self.total - self.completed)
+            status = 'OK  ' if ok else 'FAIL'
+            print(
+                f'[{self.completed}/{self.total}] {status} {name} '
+                f'(経過 {elapsed:.0f}s / 残り約 {remaining:.0f}s){" " + message if message else ""}',
+                flush=True
+            )
+
+
+def retry_delay(error, attempt):
+    """リトライまでの待機時間（秒）を返す。リトライしないエラーなら None"""
+    if isinstance(error, google_exceptions.ResourceExhausted):
+        if attempt >= QUOTA_MAX_RETRIES - 1:
+            return None
+        # 同時に 429 を受けたワーカーが揃って再送しないよう待機時間をばらつかせる
+        delay = min(QUOTA_MAX_DELAY, QUOTA_BASE_DELAY * 2 ** attempt)
+        return delay / 2 + random.uniform(0, delay / 2)
+    if isinstance(error, TRANSIENT_ERRORS) and attempt < MAX_RETRIES - 1:
+        return RETRY_DELAY * (attempt + 1)  # 徐々に待機時間を増やす
+    return None
+
+
+def enhance_image(model, prompt, path):
+    """1枚の画像を生成し、生成画像の PNG バイト列を返す"""
+    original_image = Image.open(path)
+    attempt = 0
+
+    while True:
+        try:
+            response = model.generate_content([prompt, original_image])
+
+            # 画像データの取り出し
+            if hasattr(response, 'candidates') and response.candidates:
+                for part in response.candidates[0].content.parts:
+                    if hasattr(part, 'inline_data') and part.inline_data:
+                        generated_image = Image.open(io.BytesIO(part.inline_data.data))
+                        buf = io.BytesIO()
+                        generated_image.save(buf, format='PNG')
+                        return buf.getvalue()
+            raise RuntimeError('画像の生成に失敗しました')
+        except Exception as e:
+            delay = retry_delay(e, attempt)
+            if delay is None:
+                raise
+            time.sleep(delay)
+            attempt += 1
+
+
+def process_file(model, prompt, path, key, output_dir, time_label, manifest):
+    """1ファイルを処理して出力・記録する（例外は呼び出し元に伝えない）"""
+    name = os.path.basename(path)
+    # 同名で拡張子違いの画像やオプション違いの出力が上書きし合わないよう短いハッシュを付ける
+    short_hash = hashlib.sha1(key.encode('utf-8')).hexdigest()[:8]
+    output_name = f"archienhance_{time_label}_{os.path.splitext(name)[0]}_{short_hash}.png"
+    try:
+        image_bytes = enhance_image(model, prompt, path)
+        # 完成したものから順にディスクへ書き出す
+        tmp_path = os.path.join(output_dir, output_name + '.tmp')
+        with open(tmp_path, 'wb') as f:
+            f.write(image_bytes)
+        os.replace(tmp_path, os.path.join(output_dir, output_name))
+        manifest.record(key, {'source': name, 'output': output_name, 'status': 'done'})
+        return True, ''
+    except Exception as e:
+        manifest.record(key, {'source': name, 'output': output_name, 'status': 'failed', 'error': str(e)})
+        return False, str(e)
+
+
+def parse_args(argv=None):
+    parser = argparse.ArgumentParser(description='建築パース画像をディレクトリ単位で一括高画質化します')
+    parser.add_argument('input_dir', help='入力画像のディレクトリ（例: temp/）')
+    parser.add_argument('-o', '--output-dir', default='output', help='出力ディレクトリ（既定: output）')
+    parser.add_argument('--time', choices=['day', 'night'], default='day', help='時間帯（既定: day）')
+    parser.add_argument('--no-background', action='store_true', help='背景の自動生成を行わない')
+    parser.add_argument('--no-texture', action='store_true', help='質感の強調を行わない')
+    parser.add_argument('--prompt', default='', help='追加指示（任意）')
+    parser.add_argument('-w', '--workers', type=int, default=4, help='同時実行数（既定: 4）')
+    return parser.parse_args(argv)
+
+
+def main(argv=None):
+    args = parse_args(argv)
+
+    load_dotenv()
+    api_key = os.getenv('GEMINI_API_KEY')
+    if not api_key:
+        print('APIキーが見つかりません。環境変数 GEMINI_API_KEY を設定してください。', file=sys.stderr)
+        return 1
+    genai.configure(api_key=api_key)
+    model = genai.GenerativeModel(MODEL_NAME)
+
+    is_daytime = args.time == 'day'
+    time_label = 'daytime' if is_daytime else 'nighttime'
+    prompt = build_prompt(is_daytime, not args.no_background, not args.no_texture, args.prompt)
+
+    os.makedirs(args.output_dir, exist_ok=True)
+    manifest = Manifest(os.path.join(args.output_dir, MANIFEST_NAME))
+
+    # 処理対象の列挙（処理済み・重複内容はスキップ）
+    jobs = {}
+    skipped = 0
+    for name in sorted(os.listdir(args.input_dir)):
+        path = os.path.join(args.input_dir, name)
+        if not (os.path.isfile(path) and name.lower().endswith(IMAGE_EXTENSIONS)):
+            continue
+        key = job_key(file_hash(path), prompt)
+        if manifest.is_done(key) or key in jobs:
+            skipped += 1
+            continue
+        jobs[key] = path
+
+    print(f'対象 {len(jobs)} 件（スキップ {skipped} 件）、同時実行数 {args.workers}', flush=True)
+    if not jobs:
+        return 0
+
+    progress = Progress(len(jobs))
+    executor = ThreadPoolExecutor(max_workers=max(1, args.workers))
+    try:
+        futures = {
+            executor.submit(process_file, model, prompt, path, key, args.output_dir, time_label, manifest): path
+            for key, path in jobs.items()
+        }
+        for future in as_completed(futures):
+            ok, message = future.result()
+            progress.update(os.path.basename(futures[future]), ok, message)
+    except KeyboardInterrupt:
+        # 未着手のファイルは取り消す（処理中のものは完了し次第 manifest に記録される）
+        executor.shutdown(wait=False, cancel_futures=True)
+        print(
+            f'中断しました: 完了 {progress.completed} 件 / 残り {len(jobs) - progress.completed} 件'
+            '（同じコマンドで再実行すると続きから処理します）',
+            file=sys.stderr, flush=True
+        )
+        return 130
+    executor.shutdown()
+
+    print(f'完了: 成功 {progress.completed - progress.failed} 件 / 失敗 {progress.failed} 件', flush=True)
+    return 1 if progress.failed else 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
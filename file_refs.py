@@ -0,0 +1,182 @@
+"""
+Gemini File API による画像の参照（server.py / app.py 共通）
+
+同じ画像を時間帯やプロンプトを変えて何度も生成する場合に、画像本体を毎回
+inline_data で送らず、一度だけアップロードして file_data（URI）で参照する。
+アップロード結果は内容ハッシュごとに有効期限付きでキャッシュする。
+
+    refs = FileRefCache(GeminiFileUploader(session, api_base, api_key))
+    part = refs.get_part(image_bytes, 'image/jpeg')
+    # => {'file_data': {'mime_type': 'image/jpeg', 'file_uri': 'https://...'}}
+
+テストでは GeminiFileUploader の代わりに LocalFileStub を渡す（tests/test_file_refs.py）。
+"""
+import hashlib
+import io
+import re
+import threading
+import time
+from datetime import datetime
+
+# アップロードしたファイルの保持期間（File API の既定は 48 時間）
+DEFAULT_TTL = 48 * 60 * 60  # 秒
+# 期限切れ直前の参照を避けるための余裕
+EXPIRY_MARGIN = 60 * 60  # 秒
+UPLOAD_TIMEOUT = 60  # 秒
+
+# 参照したファイル自体が使えないことを示すエラーメッセージ
+# （例: "You do not have permission to access the File abc or it may not exist."）
+FILE_REF_ERROR = re.compile(
+    r'file_?uri|file_?data'
+    r'|\bfiles?\b.*\b(not exist|not found|expired|permission|not in an active state)',
+    re.IGNORECASE
+)
+
+
+def content_hash(data):
+    """画像の内容ハッシュ（SHA-256）"""
+    return hashlib.sha256(data).hexdigest()
+
+
+def is_file_ref_error(message, file_uris=()):
+    """エラーが参照したファイル（削除・期限切れ・権限なし・無効な URI）によるものか
+
+    プロンプトや内容の問題による 400 などは False を返す（inline で送り直しても解決しない）。
+    """
+    message = message or ''
+    for file_uri in file_uris:
+        # メッセージには URI 全体か files/<id> の <id> が含まれる
+        if file_uri in message or file_uri.rstrip('/').rsplit('/', 1)[-1] in message:
+            return True
+    return bool(FILE_REF_ERROR.search(message))
+
+
+def parse_expiration(value):
+    """File API の expirationTime（RFC 3339）を UNIX 時刻に変換する"""
+    try:
+        # 小数秒はマイクロ秒（6桁）までに切り詰める
+        value = re.sub(r'(\.\d{6})\d+', r'\1', value).replace('Z', '+00:00')
+        return datetime.fromisoformat(value).timestamp()
+    except (TypeError, ValueError):
+        return time.time() + DEFAULT_TTL
+
+
+class GeminiFileUploader:
+    """REST の File API（resumable upload）でアップロードする"""
+
+    def __init__(self, session, api_base, api_key):
+        self.session = session
+        self.api_base = api_base
+        self.api_key = api_key
+
+    def upload(self, data, mime_type, display_name=None):
+        """アップロードして (file_uri, 有効期限の UNIX 時刻) を返す"""
+        start = self.session.post(
+            f'{self.api_base}/upload/v1beta/files',
+            headers={
+                'x-goog-api-key': self.api_key,
+                'X-Goog-Upload-Protocol': 'resumable',
+                'X-Goog-Upload-Command': 'start',
+                'X-Goog-Upload-Header-Content-Length': str(len(data)),
+                'X-Goog-Upload-Header-Content-Type': mime_type,
+            },
+            json={'file': {'display_name': display_name or content_hash(data)[:16]}},
+            timeout=UPLOAD_TIMEOUT
+        )
+        start.raise_for_status()
+        upload_url = start.headers['X-Goog-Upload-URL']
+
+        response = self.session.post(
+            upload_url,
+            headers={
+                'X-Goog-Upload-Offset': '0',
+                'X-Goog-Upload-Command': 'upload, finalize',
+            },
+            data=data,
+            timeout=UPLOAD_TIMEOUT
+        )
+        response.raise_for_status()
+        file = response.json()['file']
+        return file['uri'], parse_expiration(file.get('expirationTime'))
+
+
+class GenaiFileUploader:
+    """google.generativeai の upload_file でアップロードする（app.py 用）"""
+
+    def upload(self, data, mime_type, display_name=None):
+        import google.generativeai as genai
+
+        file = genai.upload_file(
+            io.BytesIO(data),
+            mime_type=mime_type,
+            display_name=display_name or content_hash(data)[:16]
+        )
+        expiration = getattr(file, 'expiration_time', None)
+        expires_at = expiration.timestamp() if expiration else time.time() + DEFAULT_TTL
+        return file.uri, expires_at
+
+
+class LocalFileStub:
+    """File API のローカル代替（テスト用）。アップロード回数を記録する"""
+
+    def __init__(self, ttl=DEFAULT_TTL):
+        self.ttl = ttl
+        self.files = {}
+        self.upload_count = 0
+        self.lock = threading.Lock()
+
+    def upload(self, data, mime_type, display_name=None):
+        with self.lock:
+            self.upload_count += 1
+            uri = f'stub://files/{self.upload_count}'
+            self.files[uri] = (data, mime_type)
+        return uri, time.time() + self.ttl
+
+
+class FileRefCache:
+    """内容ハッシュ → アップロード済みファイル URI のキャッシュ"""
+
+    def __init__(self, uploader, margin=EXPIRY_MARGIN):
+        self.uploader = uploader
+        self.margin = margin
+        self.entries = {}  # hash -> (file_uri, mime_type, expires_at)
+        self.lock = threading.Lock()
+        self.pending = {}  # hash -> アップロード中の Lock（同一画像の重複アップロード防止）
+
+    def lookup(self, digest):
+        """有効なキャッシュがあれば (file_uri, mime_type) を返す"""
+        with self.lock:
+            entry = self.entries.get(digest)
+            if entry and entry[2] - self.margin > time.time():
+                return entry[0], entry[1]
+            self.entries.pop(digest, None)
+            return None
+
+    def get_part(self, data, mime_type):
+        """画像を file_data パートとして返す（未アップロード・期限切れならアップロードする）"""
+        digest = content_hash(data)
+        cached = self.lookup(digest)
+        if cached is None:
+            with self.lock:
+                upload_lock = self.pending.setdefault(digest, threading.Lock())
+            try:
+                with upload_lock:
+                    cached = self.lookup(digest)
+                    if cached is None:
+                        file_uri, expires_at = self.uploader.upload(data, mime_type)
+                        with self.lock:
+                            self.entries[digest] = (file_uri, mime_type, expires_at)
+                        cached = (file_uri, mime_type)
+            finally:
+                # アップロードに失敗した場合もロックを残さない
+                with self.lock:
+                    if self.pending.get(digest) is upload_lock:
+                        del self.pending[digest]
+
+        file_uri, mime_type = cached
+        return {'file_data': {'mime_type': mime_type, 'file_uri': file_uri}}
+
+    def invalidate(self, data):
+        """参照できなくなったファイルをキャッシュから外す"""
+        with self.lock:
+            self.entries.pop(content_hash(data), None)
@@ -0,0 +1,72 @@
+"""
+Streamlit の再実行（rerun）ごとの処理時間計測
+
+    profiler = RerunProfiler(enabled=True)
+    ...
+    profiler.mark("サイドバー")   # 直前の mark からの経過時間を記録
+    ...
+    profiler.render()             # 計測結果をサイドバーに表示
+
+有効化: 環境変数 ARCHIENHANCE_PROFILE=1 または URL に ?profile=1
+"""
+import os
+import time
+
+import streamlit as st
+
+# 1回の再実行で目標とする処理時間（ミリ秒）。生成処理を含む再実行は対象外
+RERUN_BUDGET_MS = float(os.getenv("RERUN_BUDGET_MS", 100))
+
+
+def profiling_enabled():
+    """計測表示が有効かどうか"""
+    if os.getenv("ARCHIENHANCE_PROFILE") == "1":
+        return True
+    try:
+        return st.query_params.get("profile") == "1"
+    except Exception:
+        return False
+
+
+class RerunProfiler:
+    """区間ごとの処理時間を記録する"""
+
+    def __init__(self, enabled=None):
+        self.enabled = profiling_enabled() if enabled is None else enabled
+        self.started = time.perf_counter()
+        self.last = self.started
+        self.sections = []
+        self.exempt = False
+
+    def mark(self, name):
+        """直前の mark（または開始）から現在までを name の区間として記録する"""
+        now = time.perf_counter()
+        self.sections.append((name, (now - self.last) * 1000))
+        self.last = now
+
+    def exempt_from_budget(self):
+        """生成処理など、目標時間の対象外となる再実行として扱う"""
+        self.exempt = True
+
+    def total_ms(self):
+        return (time.perf_counter() - self.started) * 1000
+
+    def render(self):
+        """計測結果をサイドバーに表示する（無効時は何もしない）"""
+        if not self.enabled:
+            return
+
+        total = self.total_ms()
+        if self.exempt:
+            status = "生成処理を含むため対象外"
+        elif total <= RERUN_BUDGET_MS:
+            status = "OK"
+        else:
+            status = "目標超過"
+
+        rows = "\n".join(f"| {name} | {ms:.1f} |" for name, ms in self.sections)
+        with st.sidebar.expander("再実行プロファイル", expanded=True):
+            st.markdown(
+                f"| 区間 | ms |\n|---|---:|\n{rows}\n| **合計** | **{total:.1f}** |"
+            )
+            st.caption(f"目標 {RERUN_BUDGET_MS:.0f} ms: {status}")
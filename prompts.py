@@ -0,0 +1,29 @@
+# ==========================================
+# 生成プロンプトの組み立て（app.py / batch.py 共通）
+# ==========================================
+
+DAYTIME_LIGHTING = "bright natural daylight, clear blue sky, warm sunlight"
+NIGHTTIME_LIGHTING = "dramatic night lighting, warm interior glow from windows, elegant evening atmosphere"
+
+
+def build_prompt(is_daytime=True, auto_background=True, enhance_texture=True, custom_prompt=""):
+    """生成オプションから Gemini へのプロンプトを作成する"""
+    time_setting = DAYTIME_LIGHTING if is_daytime else NIGHTTIME_LIGHTING
+
+    return f"""You are an expert architectural visualizer. Enhance this building exterior perspective with professional quality.
+
+LIGHTING: {time_setting}
+
+REQUIREMENTS:
+- Significantly enhance global illumination and ambient occlusion
+- Deepen shadows for better depth perception
+- Maintain the original architectural design and proportions
+- Output a photorealistic, high-quality architectural visualization
+
+{"BACKGROUND: If the image has white or empty background areas, generate a realistic, contextual environment (sky, landscape, trees, or urban context) that seamlessly blends with the building and lighting." if auto_background else ""}
+
+{"TEXTURES: Enhance all surface materials (concrete, glass, wood, metal, stone) to appear highly detailed and photorealistic." if enhance_texture else ""}
+
+{f"ADDITIONAL INSTRUCTIONS: {custom_prompt}" if custom_prompt else ""}
+
+Deliver a stunning, professional architectural rendering."""
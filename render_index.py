@@ -0,0 +1,240 @@
+"""
+知覚ハッシュによる類似画像インデックス（server.py / app.py 共通）
+
+再保存・JPEG品質の違い・数ピクセルのトリミング程度の差しかない入力画像を
+dHash（差分ハッシュ）で検出し、過去の生成結果を再利用できるようにする。
+ハミング距離での検索には BK-tree を使う。
+"""
+import hashlib
+import io
+import json
+import os
+import threading
+import time
+import uuid
+from collections import OrderedDict
+
+from PIL import Image
+
+HASH_SIZE = 8            # 8x8 = 64bit
+MAX_DISTANCE = 10        # 類似とみなすハミング距離の上限
+INDEX_FILE = 'index.jsonl'
+MAX_ENTRIES = 200                 # 保持する生成結果の件数の上限
+MAX_BYTES = 256 * 1024 * 1024     # 保持する生成結果の合計サイズの上限
+COMPACT_SLACK = 100               # ログの書き直しを遅らせる余裕（行数）
+
+
+def dhash(image, hash_size=HASH_SIZE):
+    """画像の dHash（64bit 整数）を計算する"""
+    gray = image.convert('L').resize((hash_size + 1, hash_size), Image.LANCZOS)
+    pixels = list(gray.getdata())
+    value = 0
+    for row in range(hash_size):
+        offset = row * (hash_size + 1)
+        for col in range(hash_size):
+            value = (value << 1) | (pixels[offset + col] < pixels[offset + col + 1])
+    return value
+
+
+def hamming(a, b):
+    """2つのハッシュ間のハミング距離"""
+    return bin(a ^ b).count('1')
+
+
+def prompt_digest(prompt):
+    """生成オプションの同一性判定用にプロンプトを短いハッシュにする"""
+    return hashlib.sha1((prompt or '').encode('utf-8')).hexdigest()[:16]
+
+
+class BKTree:
+    """ハミング距離による BK-tree"""
+
+    def __init__(self):
+        self.root = None  # (hash, items, children)
+
+    def add(self, value, item):
+        if self.root is None:
+            self.root = (value, [item], {})
+            return
+        node = self.root
+        while True:
+            distance = hamming(value, node[0])
+            if distance == 0:
+                node[1].append(item)
+                return
+            child = node[2].get(distance)
+            if child is None:
+                node[2][distance] = (value, [item], {})
+                return
+            node = child
+
+    def search(self, value, max_distance):
+        """距離が max_distance 以内の (distance, item) を距離の昇順で返す"""
+        results = []
+        stack = [self.root] if self.root else []
+        while stack:
+            node = stack.pop()
+            distance = hamming(value, node[0])
+            if distance <= max_distance:
+                results.extend((distance, item) for item in node[1])
+            # 三角不等式により探索範囲を絞る
+            for d, child in node[2].items():
+                if distance - max_distance <= d <= distance + max_distance:
+                    stack.append(child)
+        results.sort(key=lambda r: r[0])
+        return results
+
+
+class RenderIndex:
+    """過去の入力画像と生成結果のインデックス（ディレクトリに永続化）
+
+    index.jsonl には追加・利用・削除を1行ずつ追記し、全体の書き直しは
+    不要になった行が溜まったときだけ行う。件数・合計サイズの上限を超えたら
+    最も長く使われていない結果から削除する。
+    """
+
+    def __init__(self, directory, max_entries=MAX_ENTRIES, max_bytes=MAX_BYTES):
+        self.directory = directory
+        self.max_entries = max_entries
+        self.max_bytes = max_bytes
+        self.lock = threading.Lock()
+        self.tree = BKTree()
+        self.entries = OrderedDict()  # output -> entry（先頭ほど長く使われていない）
+        self.total_bytes = 0
+        self.log_lines = 0
+        os.makedirs(directory, exist_ok=True)
+
+        log_path = os.path.join(directory, INDEX_FILE)
+        if os.path.exists(log_path):
+            with open(log_path, encoding='utf-8') as f:
+                for line in f:
+                    self.log_lines += 1
+                    try:
+                        record = json.loads(line)
+                    except ValueError:
+                        continue  # 書き込み途中で終了した行
+                    self._replay(record)
+            for output, entry in list(self.entries.items()):
+                if not os.path.exists(os.path.join(directory, output)):
+                    self._forget(output)
+        with self.lock:
+            self._compact(force=True)
+            self._evict()
+
+    def _replay(self, record):
+        output = record.get('output') or record.get('entry', {}).get('output')
+        if record['op'] == 'add':
+            self.entries[output] = record['entry']
+            self.total_bytes += record['entry'].get('size', 0)
+        elif record['op'] == 'use' and output in self.entries:
+            self.entries.move_to_end(output)
+        elif record['op'] == 'remove':
+            self._forget(output)
+
+    def _forget(self, output):
+        entry = self.entries.pop(output, None)
+        if entry:
+            self.total_bytes -= entry.get('size', 0)
+        return entry
+
+    def _append(self, *records):
+        with open(os.path.join(self.directory, INDEX_FILE), 'a', encoding='utf-8') as f:
+            for record in records:
+                f.write(json.dumps(record, ensure_ascii=False) + '\n')
+        self.log_lines += len(records)
+        self._compact()
+
+    def _compact(self, force=False):
+        """不要な行が溜まったら、現在の登録内容だけでログと BK-tree を作り直す"""
+        if not force and self.log_lines <= 2 * len(self.entries) + COMPACT_SLACK:
+            return
+        log_path = os.path.join(self.directory, INDEX_FILE)
+        tmp_path = log_path + '.tmp'
+        with open(tmp_path, 'w', encoding='utf-8') as f:
+            for entry in self.entries.values():
+                f.write(json.dumps({'op': 'add', 'entry': entry}, ensure_ascii=False) + '\n')
+        os.replace(tmp_path, log_path)
+        self.log_lines = len(self.entries)
+
+        self.tree = BKTree()
+        for entry in self.entries.values():
+            self.tree.add(int(entry['hash'], 16), entry)
+
+    def _evict(self):
+        """上限を超えた分を、最も長く使われていないものから削除する"""
+        removed = []
+        while self.entries and (len(self.entries) > self.max_entries or self.total_bytes > self.max_bytes):
+            output, _ = next(iter(self.entries.items()))
+            self._forget(output)
+            removed.append({'op': 'remove', 'output': output})
+            try:
+                os.remove(os.path.join(self.directory, output))
+            except OSError:
+                pass
+        if removed:
+            self._append(*removed)
+
+    def lookup(self, image, max_distance=MAX_DISTANCE, prompt=None):
+        """類似する過去の生成結果を (distance, entry) のリストで返す"""
+        return self.lookup_hash(dhash(image), max_distance, prompt)
+
+    def lookup_hash(self, value, max_distance=MAX_DISTANCE, prompt=None):
+        """dHash で検索する。prompt を指定すると同じ生成オプションの結果のみ返す"""
+        digest = prompt_digest(prompt) if prompt is not None else None
+        with self.lock:
+            # BK-tree には削除済みの結果が残るため、登録中のものだけに絞る
+            return [
+                (distance, entry) for distance, entry in self.tree.search(value, max_distance)
+                if entry['output'] in self.entries and (digest is None or entry['prompt'] == digest)
+            ]
+
+    def touch(self, entry):
+        """結果が利用されたことを記録する（削除の優先順位を下げる）"""
+        with self.lock:
+            if entry['output'] in self.entries:
+                self.entries.move_to_end(entry['output'])
+                self._append({'op': 'use', 'output': entry['output']})
+
+    def remove(self, entry):
+        """生成結果をインデックスから外す（結果のファイルが失われた場合など）"""
+        with self.lock:
+            if self._forget(entry['output']):
+                self._append({'op': 'remove', 'output': entry['output']})
+        try:
+            os.remove(os.path.join(self.directory, entry['output']))
+        except OSError:
+            pass
+
+    def add(self, image, result_bytes, prompt='', mime_type='image/png', source=''):
+        """入力画像と生成結果を登録する"""
+        extension = '.jpg' if mime_type == 'image/jpeg' else '.png'
+        output = f'{uuid.uuid4()}{extension}'
+        with open(os.path.join(self.directory, output), 'wb') as f:
+            f.write(result_bytes)
+
+        entry = {
+            'hash': f'{dhash(image):016x}',
+            'output': output,
+            'mime_type': mime_type,
+            'prompt': prompt_digest(prompt),
+            'source': source,
+            'size': len(result_bytes),
+            'created': time.time(),
+        }
+        with self.lock:
+            self.entries[output] = entry
+            self.total_bytes += entry['size']
+            self.tree.add(int(entry['hash'], 16), entry)
+            self._append({'op': 'add', 'entry': entry})
+            self._evict()
+        return entry
+
+    def read_output(self, entry):
+        """登録済みの生成結果のバイト列を返す"""
+        with open(os.path.join(self.directory, entry['output']), 'rb') as f:
+            return f.read()
+
+
+def open_image(data):
+    """バイト列から PIL 画像を開く"""
+    return Image.open(io.BytesIO(data))
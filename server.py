@@ -1,8 +1,19 @@
+import time
+
+# server.py の読み込み開始時刻（依存モジュールの読み込み時間の計測用）
+IMPORT_START = time.monotonic()
+
 from flask import Flask, request, jsonify, send_from_directory
 from flask_cors import CORS
 import requests
+from requests.adapters import HTTPAdapter
+import base64
 import os
-import time
+import threading
+from concurrent.futures import ThreadPoolExecutor
+
+from file_refs import FileRefCache, GeminiFileUploader, is_file_ref_error
+from render_index import MAX_BYTES, MAX_ENTRIES, RenderIndex, dhash, open_image
 
 app = Flask(__name__, static_folder='.')
 CORS(app)
@@ -15,18 +26,314 @@ RETRY_DELAY = 5  # 秒
 GEMINI_API_KEY = os.getenv('GEMINI_API_KEY')
 APP_PASSWORD = os.getenv('APP_PASSWORD', 'archienhance2024')
 
+# Gemini API 設定（GEMINI_API_BASE は計測・検証用に差し替え可能）
+GEMINI_API_BASE = os.getenv('GEMINI_API_BASE', 'https://generativelanguage.googleapis.com')
+GEMINI_MODEL = 'gemini-3-pro-image-preview'
+# 下書き用の安価・高速なモデル（高画質版と同じモデルでは下書きも同じ料金・時間がかかる）
+GEMINI_DRAFT_MODEL = os.getenv('GEMINI_DRAFT_MODEL', 'gemini-2.5-flash-image')
+
+# コールドスタート（プロセス起動から最初に /readyz が成功するまで）の目標時間（秒）
+COLD_START_BUDGET = float(os.getenv('COLD_START_BUDGET', 5.0))
+WARMUP_TIMEOUT = 10  # 秒
+READYZ_PROBE_TIMEOUT = 2  # 秒（/readyz からの再確認）
+
+# 類似画像インデックス（過去の生成結果の再利用）
+# Cloud Run のファイルシステムはメモリ上にあるため、件数・合計サイズに上限を設ける
+# app.py とは別のディレクトリを使う（同じディレクトリでは互いの結果を削除してしまう）
+RENDER_CACHE_DIR = os.getenv('RENDER_CACHE_DIR', os.path.join('render_cache', 'server'))
+RENDER_CACHE_MAX_ENTRIES = int(os.getenv('RENDER_CACHE_MAX_ENTRIES', MAX_ENTRIES))
+RENDER_CACHE_MAX_BYTES = int(os.getenv('RENDER_CACHE_MAX_BYTES', MAX_BYTES))
+MAX_SIMILAR_RESULTS = 1  # クライアントが提案するのは最も近い1件のみ
+render_index = RenderIndex(RENDER_CACHE_DIR, RENDER_CACHE_MAX_ENTRIES, RENDER_CACHE_MAX_BYTES)
+# 登録（画像の保存）はレスポンスを返した後にバックグラウンドで行う
+index_executor = ThreadPoolExecutor(max_workers=1)
+
+# 上流への接続を使い回すセッション（gunicorn のスレッド数に合わせたプール）
+session = requests.Session()
+session.mount('https://', HTTPAdapter(pool_connections=1, pool_maxsize=8))
+
+# アップロード済み画像の参照（同じ画像の再生成では file_data で送る）
+file_refs = FileRefCache(GeminiFileUploader(session, GEMINI_API_BASE, GEMINI_API_KEY))
+
+# 取り消された生成ジョブ（job_id -> 取り消し時刻）。Gemini への送信前に確認する
+CANCELLED_JOB_TTL = 10 * 60  # 秒
+cancelled_jobs = {}
+cancelled_lock = threading.Lock()
+
+# 起動時ウォームアップの状態（/api/config, /readyz で参照）
+startup_state = {
+    'warm': False,              # ウォームアップ処理が完了したか
+    'upstream_ok': False,       # 上流に到達できたか
+    'api_key_valid': None,      # APIキー/モデルの検証結果（None は未検証）
+    'error': None,
+    'import_seconds': None,     # server.py の読み込みにかかった時間
+    'upstream_warm_seconds': None,  # プロセス起動から上流への接続確立まで
+    'cold_start_seconds': None,  # プロセス起動から最初に /readyz が成功するまで
+}
+startup_lock = threading.Lock()
+probe_lock = threading.Lock()
+
+
+def process_started_at():
+    """プロセスの起動時刻を time.monotonic() 基準で返す
+
+    インタプリタの起動や gunicorn の準備もコールドスタートに含めるため、
+    /proc/<pid>/stat の starttime と /proc/uptime から求める。gunicorn の
+    ワーカーではマスタープロセス（親）の起動時刻を使う。/proc が無い環境では
+    server.py の読み込み開始時刻で代用する。
+    """
+    try:
+        pid = os.getpid()
+        with open(f'/proc/{os.getppid()}/cmdline', 'rb') as f:
+            if b'gunicorn' in f.read():
+                pid = os.getppid()
+        with open(f'/proc/{pid}/stat') as f:
+            # comm（2番目の項目）に空白が含まれてもよいよう ')' の後ろから数える
+            start_ticks = int(f.read().rsplit(')', 1)[1].split()[19])
+        with open('/proc/uptime') as f:
+            uptime = float(f.read().split()[0])
+        age = uptime - start_ticks / os.sysconf('SC_CLK_TCK')
+        return time.monotonic() - max(age, 0)
+    except (OSError, ValueError, IndexError):
+        return IMPORT_START
+
+
+PROCESS_START = process_started_at()
+
+
+def probe_upstream(timeout=WARMUP_TIMEOUT):
+    """上流への接続を確立し、APIキーとモデルを検証して状態を更新する"""
+    result = {'upstream_ok': False, 'api_key_valid': None, 'error': None}
+
+    if not GEMINI_API_KEY:
+        result['api_key_valid'] = False
+        result['error'] = 'APIキーが設定されていません'
+    else:
+        try:
+            # モデル情報の取得で DNS/TLS を確立し、コネクションをプールに残す
+            response = session.get(
+                f'{GEMINI_API_BASE}/v1beta/models/{GEMINI_MODEL}',
+                # エラーメッセージにキーが含まれないようヘッダーで渡す
+                headers={'x-goog-api-key': GEMINI_API_KEY},
+                timeout=timeout
+            )
+            result['upstream_ok'] = True
+            if response.status_code == 200:
+                result['api_key_valid'] = True
+            elif response.status_code in (400, 401, 403, 404):
+                result['api_key_valid'] = False
+                result['error'] = response.json().get('error', {}).get('message', 'APIキーまたはモデルが無効です')
+            else:
+                # 一時的なエラーの場合は判定を保留する
+                result['error'] = f'HTTP {response.status_code}'
+        except requests.exceptions.RequestException as e:
+            result['error'] = str(e)
+
+    elapsed = time.monotonic() - PROCESS_START
+    with startup_lock:
+        startup_state.update(result)
+        startup_state['warm'] = True
+        if result['upstream_ok'] and startup_state['upstream_warm_seconds'] is None:
+            startup_state['upstream_warm_seconds'] = round(elapsed, 3)
+
+    if result['upstream_ok']:
+        print(f'[startup] upstream warm {elapsed:.2f}s', flush=True)
+    if result['error']:
+        print(f'[startup] warmup: {result["error"]}', flush=True)
+    return result
+
+
+def warmup():
+    """起動時のウォームアップ（失敗時は /readyz で再確認する）"""
+    with probe_lock:
+        probe_upstream()
+
+def record_cold_start():
+    """最初に /readyz が成功した時点でコールドスタート時間を記録する"""
+    cold_start = time.monotonic() - PROCESS_START
+    with startup_lock:
+        if startup_state['cold_start_seconds'] is not None:
+            return
+        startup_state['cold_start_seconds'] = round(cold_start, 3)
+    print(
+        f'[startup] cold start {cold_start:.2f}s (budget {COLD_START_BUDGET:.1f}s) '
+        f'{"OK" if cold_start <= COLD_START_BUDGET else "OVER BUDGET"}',
+        flush=True
+    )
+
 @app.route('/')
 def index():
     return send_from_directory('.', 'index.html')
 
+@app.route('/healthz')
+def healthz():
+    """ライブネスチェック（ファイルI/Oなし）"""
+    return jsonify({'status': 'ok'})
+
+@app.route('/readyz')
+def readyz():
+    """レディネスチェック（上流に到達済みかつ接続プールがウォーム）"""
+    with startup_lock:
+        state = dict(startup_state)
+
+    # 前回の確認で上流に到達できなかった場合は短いタイムアウトで再確認する
+    if state['warm'] and not state['upstream_ok'] and GEMINI_API_KEY:
+        if probe_lock.acquire(blocking=False):
+            try:
+                probe_upstream(timeout=READYZ_PROBE_TIMEOUT)
+            finally:
+                probe_lock.release()
+        with startup_lock:
+            state = dict(startup_state)
+
+    ready = state['warm'] and state['upstream_ok'] and state['api_key_valid'] is not False
+    if ready and state['cold_start_seconds'] is None:
+        record_cold_start()
+        with startup_lock:
+            state['cold_start_seconds'] = startup_state['cold_start_seconds']
+    state['status'] = 'ready' if ready else 'not ready'
+    state['cold_start_budget'] = COLD_START_BUDGET
+    return jsonify(state), 200 if ready else 503
+
 @app.route('/api/config')
 def get_config():
     """クライアントに必要な設定を返す（APIキーは含まない）"""
+    with startup_lock:
+        api_key_valid = startup_state['api_key_valid']
     return jsonify({
         'password': APP_PASSWORD,
-        'hasApiKey': bool(GEMINI_API_KEY)
+        # 起動時の検証で無効と判定された場合のみ False（未検証時はキーの有無で判断）
+        'hasApiKey': bool(GEMINI_API_KEY) and api_key_valid is not False
     })
 
+def split_parts(parts):
+    """リクエストの parts からプロンプトと入力画像（バイト列, MIME タイプ）を取り出す"""
+    prompt = ''
+    image_bytes = None
+    mime_type = None
+    for part in parts:
+        if 'text' in part:
+            prompt += part['text']
+        inline_data = part.get('inline_data') or part.get('inlineData')
+        if inline_data and image_bytes is None:
+            image_bytes = base64.b64decode(inline_data.get('data', ''))
+            mime_type = inline_data.get('mime_type') or inline_data.get('mimeType')
+    return prompt, image_bytes, mime_type
+
+def index_result(parts, result):
+    """生成結果を類似画像インデックスに登録する（失敗しても生成結果には影響させない）"""
+    try:
+        prompt, image_bytes, _ = split_parts(parts)
+        if image_bytes is None:
+            return
+        for part in result.get('candidates', [{}])[0].get('content', {}).get('parts', []):
+            if 'inlineData' in part:
+                render_index.add(
+                    open_image(image_bytes),
+                    base64.b64decode(part['inlineData']['data']),
+                    prompt=prompt,
+                    mime_type=part['inlineData'].get('mimeType', 'image/png')
+                )
+                return
+    except Exception as e:
+        print(f'[render_index] 登録に失敗しました: {e}', flush=True)
+
+def to_file_refs(parts):
+    """inline_data の画像を File API の参照に置き換える（アップロード失敗時は inline のまま）"""
+    upstream_parts = []
+    sources = []
+    for part in parts:
+        inline_data = part.get('inline_data') or part.get('inlineData')
+        if inline_data:
+            image_bytes = base64.b64decode(inline_data.get('data', ''))
+            mime_type = inline_data.get('mime_type') or inline_data.get('mimeType')
+            try:
+                upstream_parts.append(file_refs.get_part(image_bytes, mime_type))
+                sources.append(image_bytes)
+                continue
+            except Exception as e:
+                print(f'[file_refs] アップロードに失敗しました: {e}', flush=True)
+        upstream_parts.append(part)
+    return upstream_parts, sources
+
+def is_invalid_file_ref(response, upstream_parts):
+    """上流のエラーが参照したファイル（削除・期限切れ・権限なし）によるものか"""
+    if response.status_code not in (400, 403, 404):
+        return False
+    try:
+        message = response.json().get('error', {}).get('message', '')
+    except ValueError:
+        message = response.text
+    file_uris = [part['file_data']['file_uri'] for part in upstream_parts if 'file_data' in part]
+    return is_file_ref_error(message, file_uris)
+
+@app.route('/api/similar', methods=['POST'])
+def similar():
+    """類似する入力画像の過去の生成結果（同じ生成オプションのもの）を返す
+
+    画像を送るのはアップロード時の1回のみで、レスポンスの hash（dHash）を
+    送れば画像なしで検索できる（生成オプションを変えた場合の再検索用）。
+    """
+    try:
+        data = request.json
+        prompt, image_bytes, _ = split_parts(data.get('parts', []))
+        if data.get('hash'):
+            try:
+                value = int(data['hash'], 16)
+            except (TypeError, ValueError):
+                return jsonify({'error': 'hash が不正です'}), 400
+        elif image_bytes is not None:
+            value = dhash(open_image(image_bytes))
+        else:
+            return jsonify({'error': '画像が含まれていません'}), 400
+
+        # 同じ生成オプションの結果だけに絞ってから件数を制限する
+        matches = []
+        for distance, entry in render_index.lookup_hash(value, prompt=prompt):
+            try:
+                output = render_index.read_output(entry)
+            except FileNotFoundError:
+                # 結果のファイルが失われていればインデックスから外す
+                render_index.remove(entry)
+                continue
+            render_index.touch(entry)
+            matches.append({
+                'distance': distance,
+                'created': entry['created'],
+                'inlineData': {
+                    'mimeType': entry['mime_type'],
+                    'data': base64.b64encode(output).decode('ascii')
+                }
+            })
+            if len(matches) >= MAX_SIMILAR_RESULTS:
+                break
+        return jsonify({'hash': f'{value:016x}', 'matches': matches})
+
+    except Exception as e:
+        return jsonify({'error': str(e)}), 500
+
+def is_cancelled(job_id):
+    """生成ジョブが取り消されているか"""
+    if not job_id:
+        return False
+    with cancelled_lock:
+        return job_id in cancelled_jobs
+
+@app.route('/api/cancel', methods=['POST'])
+def cancel():
+    """生成ジョブを取り消す（Gemini へ送信済みのリクエストは中断できない）"""
+    job_id = (request.get_json(silent=True) or {}).get('job_id')
+    if not job_id:
+        return jsonify({'error': 'job_id が指定されていません'}), 400
+
+    now = time.time()
+    with cancelled_lock:
+        # 古い取り消し記録を削除
+        for key in [k for k, t in cancelled_jobs.items() if now - t > CANCELLED_JOB_TTL]:
+            del cancelled_jobs[key]
+        cancelled_jobs[job_id] = now
+    return jsonify({'status': 'cancelled'})
+
 @app.route('/api/generate', methods=['POST'])
 def generate():
     """Gemini APIへのプロキシエンドポイント"""
@@ -35,16 +342,30 @@ def generate():
 
     try:
         data = request.json
+        parts = data.get('parts', [])
+        job_id = data.get('job_id')
         last_error = None
 
-        # リトライループ
-        for attempt in range(MAX_RETRIES):
-            # Gemini APIにリクエスト (Gemini 3 Pro Image Preview)
-            response = requests.post(
-                f'https://generativelanguage.googleapis.com/v1beta/models/gemini-3-pro-image-preview:generateContent?key={GEMINI_API_KEY}',
+        if is_cancelled(job_id):
+            return jsonify({'error': '生成が取り消されました'}), 409
+
+        # 画像は一度だけアップロードして参照で送る（下書きは小さいため inline のまま）
+        if data.get('draft'):
+            upstream_parts, ref_sources = parts, []
+        else:
+            upstream_parts, ref_sources = to_file_refs(parts)
+
+        # 下書きは安価・高速なモデルで生成する
+        model = GEMINI_DRAFT_MODEL if data.get('draft') else GEMINI_MODEL
+
+        def post_to_gemini(request_parts):
+            # Gemini APIにリクエスト（高画質版は Gemini 3 Pro Image Preview）
+            started = time.monotonic()
+            response = session.post(
+                f'{GEMINI_API_BASE}/v1beta/models/{model}:generateContent?key={GEMINI_API_KEY}',
                 json={
                     'contents': [{
-                        'parts': data.get('parts', [])
+                        'parts': request_parts
                     }],
                     'generationConfig': {
                         'responseModalities': ['TEXT', 'IMAGE']
@@ -53,9 +374,38 @@ def generate():
                 headers={'Content-Type': 'application/json'},
                 timeout=180
             )
+            # 下書きと高画質版の所要時間を比較できるよう記録する
+            print(
+                f'[generate] {model} draft={bool(data.get("draft"))} '
+                f'status={response.status_code} {time.monotonic() - started:.1f}s',
+                flush=True
+            )
+            return response
+
+        # リトライループ
+        for attempt in range(MAX_RETRIES):
+            # 取り消されたジョブは Gemini に送信しない
+            if is_cancelled(job_id):
+                return jsonify({'error': '生成が取り消されました'}), 409
+
+            response = post_to_gemini(upstream_parts)
+
+            # 参照したファイルが無効（削除・期限切れ）の場合のみ inline で送り直す（リトライ回数には数えない）
+            # プロンプトや内容の問題による 400 などはそのまま返す
+            if ref_sources and is_invalid_file_ref(response, upstream_parts):
+                for image_bytes in ref_sources:
+                    file_refs.invalidate(image_bytes)
+                upstream_parts, ref_sources = parts, []
+                if is_cancelled(job_id):
+                    return jsonify({'error': '生成が取り消されました'}), 409
+                response = post_to_gemini(upstream_parts)
 
             if response.status_code == 200:
-                return jsonify(response.json())
+                result = response.json()
+                # 下書き（縮小画像からの生成）と取り消された結果は類似画像インデックスに登録しない
+                if not data.get('draft') and not is_cancelled(job_id):
+                    index_executor.submit(index_result, parts, result)
+                return jsonify(result)
 
             error_data = response.json()
             error_message = error_data.get('error', {}).get('message', 'API request failed')
@@ -78,6 +428,13 @@ def generate():
     except Exception as e:
         return jsonify({'error': str(e)}), 500
 
+# リクエスト受付を妨げないようにバックグラウンドで実行
+threading.Thread(target=warmup, name='warmup', daemon=True).start()
+
+# コールドスタート時間は最初に /readyz が成功した時点（Cloud Run の起動プローブ）で記録する
+with startup_lock:
+    startup_state['import_seconds'] = round(time.monotonic() - IMPORT_START, 3)
+
 if __name__ == '__main__':
     port = int(os.getenv('PORT', 8080))
     app.run(host='0.0.0.0', port=port, debug=False)
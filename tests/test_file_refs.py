@@ -0,0 +1,137 @@
+"""
+file_refs.FileRefCache のテスト（File API の代わりに LocalFileStub を使う）
+
+    python -m pytest tests
+"""
+import threading
+import time
+import unittest
+from unittest import mock
+
+from file_refs import FileRefCache, LocalFileStub, is_file_ref_error
+
+IMAGE = b'\x89PNG\r\n\x1a\n' + b'\x00' * 64
+
+
+class SlowStub(LocalFileStub):
+    """アップロードに時間がかかるスタブ（同時呼び出しの確認用）"""
+
+    def upload(self, data, mime_type, display_name=None):
+        time.sleep(0.1)
+        return super().upload(data, mime_type, display_name)
+
+
+class FlakyStub(LocalFileStub):
+    """最初のアップロードだけ失敗するスタブ"""
+
+    def __init__(self):
+        super().__init__()
+        self.failures = 1
+
+    def upload(self, data, mime_type, display_name=None):
+        if self.failures:
+            self.failures -= 1
+            raise RuntimeError('upload failed')
+        return super().upload(data, mime_type, display_name)
+
+
+class FileRefCacheTest(unittest.TestCase):
+
+    def test_uploads_once_for_repeated_calls(self):
+        stub = LocalFileStub()
+        refs = FileRefCache(stub)
+
+        first = refs.get_part(IMAGE, 'image/png')
+        second = refs.get_part(IMAGE, 'image/png')
+
+        self.assertEqual(stub.upload_count, 1)
+        self.assertEqual(first, second)
+        self.assertEqual(first['file_data']['mime_type'], 'image/png')
+        self.assertIn(first['file_data']['file_uri'], stub.files)
+
+    def test_uploads_again_after_expiry(self):
+        stub = LocalFileStub(ttl=2 * 60 * 60)
+        refs = FileRefCache(stub, margin=60 * 60)
+        first = refs.get_part(IMAGE, 'image/png')
+
+        # 有効期限の余裕（margin）に入ったら再アップロードする
+        with mock.patch('file_refs.time.time', return_value=time.time() + 60 * 60 + 1):
+            second = refs.get_part(IMAGE, 'image/png')
+
+        self.assertEqual(stub.upload_count, 2)
+        self.assertNotEqual(first, second)
+
+    def test_uploads_again_after_invalidate(self):
+        stub = LocalFileStub()
+        refs = FileRefCache(stub)
+        refs.get_part(IMAGE, 'image/png')
+
+        refs.invalidate(IMAGE)
+        refs.get_part(IMAGE, 'image/png')
+
+        self.assertEqual(stub.upload_count, 2)
+
+    def test_concurrent_calls_share_one_upload(self):
+        stub = SlowStub()
+        refs = FileRefCache(stub)
+        barrier = threading.Barrier(8)
+        results = []
+
+        def worker():
+            barrier.wait()
+            results.append(refs.get_part(IMAGE, 'image/png'))
+
+        threads = [threading.Thread(target=worker) for _ in range(8)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+
+        self.assertEqual(stub.upload_count, 1)
+        self.assertEqual(len(results), 8)
+        self.assertTrue(all(result == results[0] for result in results))
+        self.assertEqual(refs.pending, {})
+
+    def test_failed_upload_does_not_leak_pending_lock(self):
+        stub = FlakyStub()
+        refs = FileRefCache(stub)
+
+        with self.assertRaises(RuntimeError):
+            refs.get_part(IMAGE, 'image/png')
+        self.assertEqual(refs.pending, {})
+
+        # 失敗後も同じ画像をアップロードできる
+        refs.get_part(IMAGE, 'image/png')
+        self.assertEqual(stub.upload_count, 1)
+        self.assertEqual(refs.pending, {})
+
+
+class FileRefErrorTest(unittest.TestCase):
+
+    URI = 'https://generativelanguage.googleapis.com/v1beta/files/abc123'
+
+    def test_errors_about_the_referenced_file(self):
+        for message in (
+            'You do not have permission to access the File abc123 or it may not exist.',
+            'The File xyz is not in an ACTIVE state and usage is not allowed.',
+            'File has expired.',
+            'Invalid file_uri.',
+            f'Failed to read {self.URI}',
+        ):
+            with self.subTest(message=message):
+                self.assertTrue(is_file_ref_error(message, [self.URI]))
+
+    def test_other_request_errors(self):
+        for message in (
+            'Request contains an invalid argument.',
+            'Unsupported MIME type: image/gif',
+            'The prompt was blocked due to safety reasons.',
+            '',
+            None,
+        ):
+            with self.subTest(message=message):
+                self.assertFalse(is_file_ref_error(message, [self.URI]))
+
+
+if __name__ == '__main__':
+    unittest.main()